@@ -3,10 +3,12 @@ import io
 import logging
 import os
 import string
-from dataclasses import dataclass
+import time
+from collections import Counter, deque
+from dataclasses import dataclass, field
 from datetime import datetime
 from types import coroutine
-from typing import Optional, Union, List, Tuple, Callable
+from typing import Optional, Union, List, Tuple, Callable, Deque, Dict
 
 import aiohttp.client_exceptions
 import aiosqlite
@@ -40,6 +42,14 @@ CREATE TABLE IF NOT EXISTS "messages" (
 CREATE TABLE IF NOT EXISTS "banned" (
     "id" INTEGER NOT NULL,
     "is_user" INTEGER NOT NULL
+);;
+CREATE TABLE IF NOT EXISTS "actions" (
+    "guild" INTEGER NOT NULL,
+    "moderator" INTEGER NOT NULL,
+    "target" INTEGER NOT NULL,
+    "action" TEXT NOT NULL,
+    "result" TEXT NOT NULL,
+    "time" TEXT NOT NULL
 )
 """
 
@@ -131,6 +141,22 @@ class BlackListContext(commands.Context):
                 await self.send("You took too long to respond ): Try to start over", delete_after=del_error)
                 return (None, None) if return_author else None
 
+    @staticmethod
+    def _embed_files(embed: discord.Embed, image: Optional[Union[str, io.BufferedIOBase]],
+                     attachment: Optional[Tuple[str, io.BufferedIOBase]]) -> List[discord.File]:
+        files = []
+        if image:
+            if isinstance(image, str):
+                embed.set_image(url=image)
+            else:
+                image.seek(0)
+                files.append(discord.File(image, filename="image.png"))
+                embed.set_image(url="attachment://image.png")
+        if attachment:
+            attachment[1].seek(0)
+            files.append(discord.File(attachment[1], filename=attachment[0]))
+        return files
+
     # noinspection PyDefaultArgument
     async def channel_embed(self, *,
                             channel: Union[int, discord.abc.Messageable],
@@ -143,6 +169,7 @@ class BlackListContext(commands.Context):
                             thumbnail: str = None,
                             clr: discord.Colour = None,
                             image: Union[str, io.BufferedIOBase] = None,
+                            attachment: Tuple[str, io.BufferedIOBase] = None,
                             footer: str = None,
                             not_inline: List[int] = [],
                             trash_reaction: bool = False):
@@ -158,23 +185,14 @@ class BlackListContext(commands.Context):
         )
         if author:
             embed.set_author(name=author)
-        if image:
-            if isinstance(image, str):
-                embed.set_image(url=image)
-                f = None
-            else:
-                image.seek(0)
-                f = discord.File(image, filename="image.png")
-                embed.set_image(url="attachment://image.png")
-        else:
-            f = None
+        files = self._embed_files(embed, image, attachment)
         if footer:
             embed.set_footer(text=footer)
         if thumbnail:
             embed.set_thumbnail(url=thumbnail)
         for n, r in enumerate(fields or []):
             embed.add_field(name=r[0], value=r[1] or "None", inline=n not in not_inline)
-        msg = await channel.send(embed=embed, file=f)
+        msg = await channel.send(embed=embed, files=files or None)
         if trash_reaction:
             await channel.trash_reaction(msg)
         return msg
@@ -190,6 +208,7 @@ class BlackListContext(commands.Context):
                     thumbnail: str = None,
                     clr: discord.Colour = None,
                     image: Union[str, io.BufferedIOBase] = None,
+                    attachment: Tuple[str, io.BufferedIOBase] = None,
                     footer: str = None,
                     not_inline: List[int] = [],
                     trash_reaction: bool = False):
@@ -203,23 +222,14 @@ class BlackListContext(commands.Context):
         )
         if author:
             embed.set_author(name=author)
-        if image:
-            if isinstance(image, str):
-                embed.set_image(url=image)
-                f = None
-            else:
-                image.seek(0)
-                f = discord.File(image, filename="image.png")
-                embed.set_image(url="attachment://image.png")
-        else:
-            f = None
+        files = self._embed_files(embed, image, attachment)
         if footer:
             embed.set_footer(text=footer)
         if thumbnail:
             embed.set_thumbnail(url=thumbnail)
         for n, r in enumerate(fields or []):
             embed.add_field(name=r[0], value=r[1] or "None", inline=n not in not_inline)
-        msg = await self.send(embed=embed, file=f)
+        msg = await self.send(embed=embed, files=files or None)
         if trash_reaction:
             await self.trash_reaction(msg)
         return msg
@@ -256,6 +266,8 @@ class BlackListBot(commands.Bot):
         self.cog_groups = {}
         self.db = Database()
         self.ksoft: Optional[ksoftapi.Client] = None
+        self.ksoft_token: Optional[str] = None
+        self.flight_recorder = FlightRecorder()
 
         #  self.version = "+".join(subprocess.check_output(["git", "describe", "--tags"]).
         #                        strip().decode("utf-8").split("-")[:-1])
@@ -272,6 +284,28 @@ class BlackListBot(commands.Bot):
         ctx: BlackListContext = await self.get_context(message, cls=BlackListContext)
         await self.invoke(ctx)
 
+    async def _run_event(self, coro, event_name, *args, **kwargs):
+        # every dispatched handler, cog listeners included, runs in its own task through here
+        task = asyncio.current_task()
+        self.flight_recorder.start(task, event_name, coro)
+        try:
+            await super(BlackListBot, self)._run_event(coro, event_name, *args, **kwargs)
+        finally:
+            self.flight_recorder.finish(task)
+
+    def wait_for(self, event, *, check=None, timeout=None):
+        # time spent waiting on a user reply or reaction isn't the handler being slow. the listener is still
+        # registered right away like Client.wait_for, only the awaiting is wrapped
+        task = asyncio.current_task(self.loop)
+        self.flight_recorder.pause(task)
+        return self._resume_after(task, super(BlackListBot, self).wait_for(event, check=check, timeout=timeout))
+
+    async def _resume_after(self, task: Optional[asyncio.Task], waiter):
+        try:
+            return await waiter
+        finally:
+            self.flight_recorder.resume(task)
+
     async def start(self, *args, **kwargs):  # noqa: C901
         """|coro|
         A shorthand coroutine for :meth:`login` + :meth:`connect`.
@@ -285,7 +319,8 @@ class BlackListBot(commands.Bot):
         await self.db.load()
 
         logging.info("bot:Loading KSoft Client")
-        self.ksoft = ksoftapi.Client(os.getenv("KSOFT"))
+        self.ksoft_token = os.getenv("KSOFT")
+        self.ksoft = ksoftapi.Client(self.ksoft_token)
         logging.info("bot:Loaded KSoft Client")
 
         if kwargs:
@@ -340,6 +375,82 @@ class Report:
     reason: str
 
 
+@dataclass(frozen=True)
+class SlowEvent:
+    event: str
+    handler: str
+    started: datetime
+    duration: float
+    awaits: Tuple[Tuple[str, int], ...]
+
+
+@dataclass
+class _RunningEvent:
+    event: str
+    handler: str
+    started: datetime
+    perf: float
+    awaits: Counter = field(default_factory=Counter)
+    waited: float = 0.0
+    paused: Optional[float] = None
+    waits: int = 0
+
+
+def _await_location(coro, depth: int = 3) -> str:
+    frames = []
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        frames.append(f"{frame.f_code.co_name}:{frame.f_lineno}")
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return " > ".join(frames[-depth:]) or "<running>"
+
+
+class FlightRecorder:
+    """Keeps the last ``size`` event handler invocations that took longer than ``threshold`` seconds"""
+
+    def __init__(self, size: int = 25, threshold: float = 1.0):
+        self.threshold = threshold
+        self.events: Deque[SlowEvent] = deque(maxlen=size)
+        self.running: Dict[asyncio.Task, _RunningEvent] = {}
+
+    def resize(self, size: int):
+        self.events = deque(self.events, maxlen=size)
+
+    def start(self, task: asyncio.Task, event: str, handler: Callable):
+        self.running[task] = _RunningEvent(event, getattr(handler, "__qualname__", str(handler)),
+                                           datetime.now(), time.perf_counter())
+
+    def pause(self, task: Optional[asyncio.Task]):
+        if running := self.running.get(task):
+            if not running.waits:
+                running.paused = time.perf_counter()
+            running.waits += 1
+
+    def resume(self, task: Optional[asyncio.Task]):
+        if (running := self.running.get(task)) and running.waits:
+            running.waits -= 1
+            if not running.waits:
+                running.waited += time.perf_counter() - running.paused
+                running.paused = None
+
+    def sample(self):
+        now = time.perf_counter()
+        for task, running in self.running.items():
+            if running.paused is None and now - running.perf - running.waited >= self.threshold:
+                running.awaits[_await_location(task.get_coro())] += 1
+
+    def finish(self, task: asyncio.Task):
+        running = self.running.pop(task, None)
+        if not running:
+            return
+        duration = time.perf_counter() - running.perf - running.waited
+        if duration >= self.threshold:
+            self.events.append(SlowEvent(running.event, running.handler, running.started, duration,
+                                         tuple(running.awaits.most_common(5))))
+
+
 class Database:
     def __init__(self):
         self.db: Optional[Connection] = None
@@ -0,0 +1,223 @@
+import asyncio
+import cProfile
+import gzip
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter, deque
+from typing import Optional, Deque, Union
+
+import discord
+import humanize
+from discord.ext import commands
+
+from bot import BlackListContext, BlackListBot
+
+
+class StackSampler(threading.Thread):
+    """Periodically snapshots the event loop thread's stack from a side thread"""
+
+    MAX_STACKS = 2000
+
+    def __init__(self, thread_id: int, interval: float):
+        super(StackSampler, self).__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+                self.samples += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def summary(self) -> str:
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        lines = [f"{self.samples} samples every {self.interval * 1000:.0f}ms", "", "Top functions (self samples):"]
+        lines += [f"{count:>8} {count / self.samples:>7.1%}  {leaf}" for leaf, count in leaves.most_common(30)]
+        lines += ["", "Collapsed stacks (flamegraph.pl compatible):"]
+        lines += [f"{stack} {count}" for stack, count in self.stacks.most_common(self.MAX_STACKS)]
+        if len(self.stacks) > self.MAX_STACKS:
+            lines.append(f"... {len(self.stacks) - self.MAX_STACKS} rarer stacks omitted")
+        return "\n".join(lines)
+
+
+class Profiler(commands.Cog):
+    SAMPLE_INTERVAL = 0.005
+    LAG_INTERVAL = 0.25
+    EMBED_BUDGET = 5500
+    UPLOAD_LIMIT = 4 * 1024 * 1024
+
+    def __init__(self, bot: BlackListBot):
+        self.bot = bot
+        self.session: Optional[Union[StackSampler, cProfile.Profile]] = None
+        self.session_start = 0.0
+        self.lag_threshold = 0.1
+        self.lag_samples: Deque[float] = deque(maxlen=240)
+        self.lag_breaches = 0
+        self.lag_task = bot.loop.create_task(self._monitor_lag())
+        logging.info("Loaded Profiler")
+
+    @property
+    def description(self):
+        return "Profiling commands"
+
+    def cog_unload(self):
+        self.lag_task.cancel()
+        if isinstance(self.session, StackSampler):
+            self.session.stop()
+        elif self.session:
+            self.session.disable()
+
+    async def cog_check(self, ctx: BlackListContext):
+        return await self.bot.is_owner(ctx.author)
+
+    async def _monitor_lag(self):
+        while True:
+            start = self.bot.loop.time()
+            await asyncio.sleep(self.LAG_INTERVAL)
+            lag = self.bot.loop.time() - start - self.LAG_INTERVAL
+            self.lag_samples.append(lag)
+            if lag >= self.lag_threshold:
+                self.lag_breaches += 1
+                logging.warning(f"profiler:event loop lagged {lag * 1000:.0f}ms")
+            self.bot.flight_recorder.sample()
+
+    @commands.group(
+        brief="Profiles the running bot",
+        invoke_without_command=True
+    )
+    async def profile(self, ctx: BlackListContext):
+        await ctx.send_info("Use `bl!profile start [sample|cprofile]`, `bl!profile stop`, `bl!profile slow`, "
+                            "`bl!profile recorder <size> <seconds>`, `bl!profile lag` or "
+                            "`bl!profile lagthreshold <ms>`")
+
+    @profile.command(
+        brief="Starts a profiling session on the event loop"
+    )
+    async def start(self, ctx: BlackListContext, mode: str = "sample"):
+        if self.session:
+            return await ctx.send_error("A profiling session is already running")
+        if mode == "sample":
+            self.session = StackSampler(threading.get_ident(), self.SAMPLE_INTERVAL)
+            self.session.start()
+        elif mode == "cprofile":
+            # enabled from the loop thread, so it sees every coroutine step the loop runs
+            self.session = cProfile.Profile()
+            self.session.enable()
+        else:
+            return await ctx.send_error("Mode must be `sample` or `cprofile`")
+        self.session_start = time.perf_counter()
+        await ctx.send_ok(f"Started a `{mode}` profiling session")
+
+    @profile.command(
+        brief="Stops the profiling session and uploads the results"
+    )
+    async def stop(self, ctx: BlackListContext):
+        if not self.session:
+            return await ctx.send_error("No profiling session is running")
+        duration = time.perf_counter() - self.session_start
+        if isinstance(self.session, StackSampler):
+            self.session.stop()
+            result = self.session.summary()
+        else:
+            self.session.disable()
+            out = io.StringIO()
+            pstats.Stats(self.session, stream=out).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(60)
+            result = out.getvalue()
+        data = result.encode()
+        attachment = ("profile.txt", io.BytesIO(data))
+        if len(data) > self.UPLOAD_LIMIT:
+            attachment = ("profile.txt.gz", io.BytesIO(gzip.compress(data)))
+        # keep the stopped session around until the upload works, so a failed upload can be retried with stop
+        await ctx.embed(
+            title="Profiling session finished",
+            description=f"Profiled for **{humanize.naturaldelta(duration)}**",
+            attachment=attachment
+        )
+        self.session = None
+
+    @profile.command(
+        brief="Lists the most recent slow event handlers"
+    )
+    async def slow(self, ctx: BlackListContext, count: int = 10):
+        events = list(self.bot.flight_recorder.events)[-max(1, min(count, 25)):]
+        if not events:
+            return await ctx.send_info("No slow event handlers have been recorded")
+        fields = []
+        budget = self.EMBED_BUDGET
+        for e in reversed(events):
+            name = f"{e.handler} ({e.event}) - {e.duration:.2f}s"[:256]
+            value = (f"at {e.started:%H:%M:%S}\n" + "\n".join(f"`{loc}` x{n}" for loc, n in e.awaits))[:1024]
+            budget -= len(name) + len(value)
+            if budget < 0:
+                break
+            fields.append((name, value))
+        await ctx.embed(
+            title="Slow event handlers",
+            fields=fields,
+            not_inline=list(range(len(fields))),
+            footer=f"Showing {len(fields)} of {len(self.bot.flight_recorder.events)} recorded"
+        )
+
+    @profile.command(
+        brief="Sets the flight recorder's size and slow handler threshold"
+    )
+    async def recorder(self, ctx: BlackListContext, size: int, seconds: float):
+        if size <= 0:
+            return await ctx.send_error("The recorder size must be at least 1")
+        if seconds < 0:
+            return await ctx.send_error("The slow handler threshold can't be negative")
+        self.bot.flight_recorder.resize(size)
+        self.bot.flight_recorder.threshold = seconds
+        await ctx.send_ok(f"Keeping the last {size} handlers slower than {seconds}s")
+
+    @profile.command(
+        brief="Shows event loop lag statistics"
+    )
+    async def lag(self, ctx: BlackListContext):
+        samples = sorted(self.lag_samples)
+        if not samples:
+            return await ctx.send_info("No lag samples yet")
+        await ctx.embed(
+            title="Event loop lag",
+            fields=[
+                ("Average", f"{sum(samples) / len(samples) * 1000:.1f}ms"),
+                ("95th percentile", f"{samples[int(len(samples) * 0.95) - 1] * 1000:.1f}ms"),
+                ("Max", f"{samples[-1] * 1000:.1f}ms"),
+                ("Threshold", f"{self.lag_threshold * 1000:.0f}ms"),
+                ("Breaches", f"{self.lag_breaches}")
+            ],
+            footer=f"Last {len(samples)} samples, one every {self.LAG_INTERVAL * 1000:.0f}ms"
+        )
+
+    @profile.command(
+        brief="Sets the event loop lag warning threshold"
+    )
+    async def lagthreshold(self, ctx: BlackListContext, ms: int):
+        if ms < 0:
+            return await ctx.send_error("The lag threshold can't be negative")
+        self.lag_threshold = ms / 1000
+        await ctx.send_ok(f"Event loop lag threshold set to {ms}ms")
+
+
+def setup(bot):
+    bot.add_cog(Profiler(bot))
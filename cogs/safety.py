@@ -1,10 +1,13 @@
+import asyncio
 import logging
 import random
 import string
 from datetime import datetime, timedelta
-from typing import Tuple, Dict, List
+from typing import Tuple, Dict, List, Optional, Set
 
+import aiohttp
 import discord
+import disputils
 import humanize
 from discord.ext import commands
 
@@ -18,6 +21,15 @@ def add_desc(msg: discord.Message, text: str) -> discord.Embed:
 
 
 class Safety(commands.Cog):
+    RAID_CONCURRENCY = 5
+    RAID_PROGRESS_INTERVAL = 2.0
+    AUDIT_CHUNK = 1000
+    AUDIT_PAGE_SIZE = 15
+    BAN_CACHE_SECONDS = 600
+    KSOFT_BANS_URL = "https://api.ksoft.si/bans/list"
+    KSOFT_BANS_PAGE = 1000
+    KSOFT_BANS_SECONDS = 1800
+
     def __init__(self, bot: BlackListBot):
         self.bot = bot
         self.cache: Dict[int, Tuple[datetime, bool]] = {}
@@ -27,6 +39,8 @@ class Safety(commands.Cog):
         self.banned_guilds: List = []
         self.reports: List[Report] = []
         self.messages: List[Tuple[int, int, str]] = []
+        self.ksoft_bans: Optional[Tuple[datetime, Set[int]]] = None
+        self.ksoft_bans_lock = asyncio.Lock()
         bot.loop.create_task(self._init())
 
     async def _init(self):
@@ -51,9 +65,9 @@ class Safety(commands.Cog):
     def description(self):
         return "Safety commands"
 
-    async def lookup_is_banned(self, user: discord.Member) -> Tuple[timedelta, bool]:
-        if user in self.cache:
-            if (datetime.now() - self.cache[user.id][0]).seconds > 600:
+    async def lookup_is_banned(self, user: discord.abc.Snowflake) -> Tuple[timedelta, bool]:
+        if user.id in self.cache:
+            if (datetime.now() - self.cache[user.id][0]).total_seconds() > self.BAN_CACHE_SECONDS:
                 del self.cache[user.id]
             else:
                 return datetime.now() - self.cache[user.id][0], self.cache[user.id][1]
@@ -61,6 +75,26 @@ class Safety(commands.Cog):
         self.cache[user.id] = datetime.now(), ban
         return timedelta(0), ban
 
+    async def ksoft_banned_ids(self) -> Set[int]:
+        """Pulls KSoft's whole ban list a page at a time, cached for ``KSOFT_BANS_SECONDS``"""
+        async with self.ksoft_bans_lock:
+            if self.ksoft_bans and (datetime.now() - self.ksoft_bans[0]).total_seconds() < self.KSOFT_BANS_SECONDS:
+                return self.ksoft_bans[1]
+            banned = set()
+            page = 1
+            # same token as self.bot.ksoft, which has no wrapper for the paginated list
+            async with aiohttp.ClientSession(headers={"Authorization": f"Bearer {self.bot.ksoft_token}"},
+                                             timeout=aiohttp.ClientTimeout(total=60)) as session:
+                while page:
+                    async with session.get(self.KSOFT_BANS_URL,
+                                           params={"page": page, "per_page": self.KSOFT_BANS_PAGE}) as resp:
+                        resp.raise_for_status()
+                        data = await resp.json()
+                    banned.update(int(b["id"]) for b in data["data"] if b.get("is_ban_active"))
+                    page = data.get("next_page")
+            self.ksoft_bans = datetime.now(), banned
+            return banned
+
     @commands.command(
         brief="Looks up a user's information",
         aliases=["userinfo"]
@@ -154,15 +188,23 @@ class Safety(commands.Cog):
             await self.bot.db.db.execute_insert("INSERT INTO guilds VALUES (?,?,?,?)", (guild.id, 0, 0, 0))
         await self.bot.db.db.commit()
 
+    @staticmethod
+    def _is_suspicious(member: discord.Member, reported: bool, banned: bool) -> bool:
+        account_age = (datetime.utcnow() - member.created_at).days
+        return (account_age < 30 or reported or banned) and not member.bot
+
+    async def _record_actions(self, rows: List[Tuple[int, int, int, str, str, str]]):
+        await self.bot.db.db.executemany("insert into actions values (?,?,?,?,?,?)", rows)
+        await self.bot.db.db.commit()
+
     @commands.Cog.listener()
     async def on_member_join(self, member: discord.Member):
         await self._ensure_guild_entry(member.guild)
-        account_age = (datetime.now() - member.created_at).days
         reports = await self._get_reports(member)
         updated, banned = await self.lookup_is_banned(member)
 
-        if (account_age < 30 or reports or banned) and self.bot.get_channel(self.guild_settings[member.guild.id][2]) \
-                and not member.bot:
+        if self._is_suspicious(member, bool(reports), banned) \
+                and self.bot.get_channel(self.guild_settings[member.guild.id][2]):
             await self.bot.get_channel(self.guild_settings[member.guild.id][2]).send(
                 embed=discord.Embed(
                     title="Suspicious Account Joined",
@@ -239,6 +281,266 @@ class Safety(commands.Cog):
         await self.bot.db.db.commit()
         await ctx.send_ok("Report was sent!")
 
+    @commands.guild_only()
+    @commands.has_guild_permissions(manage_guild=True)
+    @commands.cooldown(1, 600, commands.BucketType.guild)
+    @commands.command(
+        brief="Checks every member of the server against reports and KSoft bans"
+    )
+    async def audit(self, ctx: BlackListContext):
+        try:
+            await self._run_audit(ctx)
+        except Exception:
+            ctx.command.reset_cooldown(ctx)
+            raise
+
+    async def _run_audit(self, ctx: BlackListContext):
+        rows = await self.bot.db.db.execute_fetchall(
+            "SELECT reported, COUNT(DISTINCT id) FROM reports GROUP BY reported")
+        reported: Dict[int, int] = {r[0]: r[1] for r in rows}
+        flagged: List[Tuple[str, int, bool]] = []
+        checked = 0
+        ksoft_error: Optional[str] = None
+        progress = await ctx.send(embed=self._audit_embed(ctx.guild, checked, 0, False, ksoft_error))
+        try:
+            banned = await self.ksoft_banned_ids()
+        except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError) as e:
+            logging.warning(f"safety:fetching the ksoft ban list failed: {e!r}")
+            banned, ksoft_error = set(), f"KSoft's ban list could not be fetched ({type(e).__name__}), " \
+                                         f"only reports were checked"
+            # a partial audit shouldn't lock the server out of retrying
+            ctx.command.reset_cooldown(ctx)
+
+        # members are fetched a page at a time and dropped after each chunk, only flagged ones are kept
+        chunk: List[discord.Member] = []
+        async for member in ctx.guild.fetch_members(limit=None):
+            if member.bot:
+                checked += 1
+                continue
+            chunk.append(member)
+            if len(chunk) >= self.AUDIT_CHUNK:
+                flagged += self._audit_chunk(chunk, reported, banned)
+                checked += len(chunk)
+                chunk = []
+                await progress.edit(embed=self._audit_embed(ctx.guild, checked, len(flagged), False, ksoft_error))
+        flagged += self._audit_chunk(chunk, reported, banned)
+        checked += len(chunk)
+        await progress.edit(embed=self._audit_embed(ctx.guild, checked, len(flagged), True, ksoft_error))
+
+        if not flagged:
+            if ksoft_error:
+                return await ctx.send_error(f"No members have reports. {ksoft_error}")
+            return await ctx.send_ok("No members have reports or KSoft bans")
+        flagged.sort(key=lambda f: (not f[2], -f[1]))
+        pages = []
+        for i in range(0, len(flagged), self.AUDIT_PAGE_SIZE):
+            page = discord.Embed(
+                title=f"Audit of {ctx.guild} - {len(flagged)} flagged",
+                description="\n".join(f"{name} - {n} reports{' - **KSoft banned**' if b else ''}"
+                                       for name, n, b in flagged[i:i + self.AUDIT_PAGE_SIZE]),
+                colour=discord.Colour.red()
+            )
+            if ksoft_error:
+                page.set_footer(text=ksoft_error)
+            pages.append(page)
+        await disputils.BotEmbedPaginator(ctx, pages).run()
+
+    @staticmethod
+    def _audit_embed(guild: discord.Guild, checked: int, flagged: int, finished: bool,
+                     ksoft_error: Optional[str]) -> discord.Embed:
+        embed = discord.Embed(
+            title=f"Audit {'finished' if finished else 'in progress'}",
+            description=f"**{checked}**/**{guild.member_count}** members checked, **{flagged}** flagged",
+            colour=discord.Colour.red() if ksoft_error else
+            discord.Colour.green() if finished else discord.Colour.blue()
+        )
+        if ksoft_error:
+            embed.set_footer(text=ksoft_error)
+        return embed
+
+    @staticmethod
+    def _audit_chunk(chunk: List[discord.Member], reported: Dict[int, int],
+                     banned: Set[int]) -> List[Tuple[str, int, bool]]:
+        ids = {m.id for m in chunk}
+        # iterate the chunk side so each chunk costs O(chunk), not O(reports + bans)
+        hits = {i for i in ids if i in reported} | (ids & banned)
+        return [(f"{m} ({m.id})", reported.get(m.id, 0), m.id in banned) for m in chunk if m.id in hits]
+
+    @commands.guild_only()
+    @commands.group(
+        brief="Bulk moderation for cleaning up after a raid",
+        invoke_without_command=True
+    )
+    async def raid(self, ctx: BlackListContext):
+        await ctx.send_info("Use `bl!raid ban|kick <minutes> [dry run]` to act on suspicious accounts that joined in "
+                            "the last `minutes` minutes, or `bl!raid banusers|kickusers <dry run> <ids...>` to act on "
+                            "a list of user IDs, such as the ones from a raid alert")
+
+    @commands.has_guild_permissions(ban_members=True)
+    @commands.bot_has_guild_permissions(ban_members=True)
+    @raid.command(
+        name="ban",
+        brief="Bans suspicious accounts that joined in the last N minutes"
+    )
+    async def raid_ban(self, ctx: BlackListContext, minutes: int, dry_run: bool = False):
+        targets, failed_lookups = await self._recent_suspicious(ctx.guild, minutes)
+        note = f"KSoft lookups failed for {failed_lookups} recent members, they were not included" \
+            if failed_lookups else None
+        await self._bulk_action(ctx, ctx.BAN, targets, dry_run, note)
+
+    @commands.has_guild_permissions(kick_members=True)
+    @commands.bot_has_guild_permissions(kick_members=True)
+    @raid.command(
+        name="kick",
+        brief="Kicks suspicious accounts that joined in the last N minutes"
+    )
+    async def raid_kick(self, ctx: BlackListContext, minutes: int, dry_run: bool = False):
+        targets, failed_lookups = await self._recent_suspicious(ctx.guild, minutes)
+        note = f"KSoft lookups failed for {failed_lookups} recent members, they were not included" \
+            if failed_lookups else None
+        await self._bulk_action(ctx, ctx.KICK, targets, dry_run, note)
+
+    @commands.has_guild_permissions(ban_members=True)
+    @commands.bot_has_guild_permissions(ban_members=True)
+    @raid.command(
+        name="banusers",
+        brief="Bans a list of user IDs"
+    )
+    async def raid_banusers(self, ctx: BlackListContext, dry_run: bool, users: commands.Greedy[int]):
+        await self._bulk_action(ctx, ctx.BAN, [discord.Object(u) for u in set(users)], dry_run)
+
+    @commands.has_guild_permissions(kick_members=True)
+    @commands.bot_has_guild_permissions(kick_members=True)
+    @raid.command(
+        name="kickusers",
+        brief="Kicks a list of user IDs"
+    )
+    async def raid_kickusers(self, ctx: BlackListContext, dry_run: bool, users: commands.Greedy[int]):
+        await self._bulk_action(ctx, ctx.KICK, [discord.Object(u) for u in set(users)], dry_run)
+
+    async def _recent_suspicious(self, guild: discord.Guild,
+                                 minutes: int) -> Tuple[List[discord.Member], int]:
+        cutoff = datetime.utcnow() - timedelta(minutes=minutes)
+        recent = [m for m in guild.members if not m.bot and m.joined_at and m.joined_at > cutoff]
+        reported = {r.reported for r in self.reports}
+        semaphore = asyncio.Semaphore(self.RAID_CONCURRENCY)
+
+        async def check(member: discord.Member) -> Optional[bool]:
+            # new or reported accounts are already suspicious, only the rest need a KSoft call
+            if self._is_suspicious(member, member.id in reported, False):
+                return True
+            async with semaphore:
+                try:
+                    _, banned = await self.lookup_is_banned(member)
+                except Exception as e:
+                    logging.warning(f"safety:raid ksoft lookup for {member.id} failed: {e}")
+                    return None
+            return banned
+
+        flags = await asyncio.gather(*(check(m) for m in recent))
+        return [m for m, flagged in zip(recent, flags) if flagged], sum(1 for f in flags if f is None)
+
+    @staticmethod
+    def _progress_embed(verb: str, rows: List[Tuple[int, int, int, str, str, str]], total: int,
+                        finished: bool) -> discord.Embed:
+        failed = sum(1 for r in rows if r[4] not in ("ok", "skipped"))
+        skipped = sum(1 for r in rows if r[4] == "skipped")
+        return discord.Embed(
+            title=f"{verb} {'finished' if finished else 'in progress'}",
+            description=f"**{len(rows)}**/**{total}** processed, **{failed}** failed, **{skipped}** skipped",
+            colour=discord.Colour.green() if finished else discord.Colour.blue()
+        )
+
+    @staticmethod
+    def _is_protected(ctx: BlackListContext, target: discord.abc.Snowflake) -> bool:
+        if target.id in (ctx.guild.owner_id, ctx.author_id, ctx.me.id):
+            return True
+        member = ctx.guild.get_member(target.id)
+        # the same hierarchy rule Discord applies to a moderator banning by hand
+        return bool(member) and ctx.author_id != ctx.guild.owner_id and member.top_role >= ctx.author.top_role
+
+    async def _confirm_bulk_action(self, ctx: BlackListContext, verb: str, targets: List[discord.abc.Snowflake],
+                                   dry_run: bool, note: Optional[str]) -> bool:
+        if not targets:
+            await ctx.send_info(f"No matching users were found{f'. {note}' if note else ''}")
+            return False
+        if dry_run:
+            listing = "\n".join(f"{t} - {t.id}" if isinstance(t, discord.Member) else str(t.id) for t in targets)
+            await ctx.embed(
+                title=f"Dry run: {verb.lower()} {len(targets)} users",
+                description=listing[:2000],
+                footer=f"No action was taken{f'. {note}' if note else ''}"
+            )
+            return False
+        if note:
+            await ctx.send_info(note)
+        return await ctx.confirm(f"{verb} {len(targets)} users?", f"{verb} confirmed", f"{verb} cancelled")
+
+    async def _bulk_target(self, ctx: BlackListContext, action: str, target: discord.abc.Snowflake,
+                           semaphore: asyncio.Semaphore) -> str:
+        reason = f"Raid cleanup by {ctx.author} ({ctx.author_id})"
+        # discord.py already waits out 429s per route, the semaphore keeps us from queueing hundreds at once
+        async with semaphore:
+            try:
+                if action == ctx.BAN:
+                    await ctx.guild.ban(target, reason=reason, delete_message_days=1)
+                else:
+                    await ctx.guild.kick(target, reason=reason)
+                return "ok"
+            except discord.NotFound:
+                return "not found"
+            except discord.Forbidden:
+                return "forbidden"
+            except discord.HTTPException as e:
+                return f"error {e.status}"
+            except Exception as e:
+                logging.warning(f"safety:raid action on {target.id} failed: {e}")
+                return f"error {type(e).__name__}"
+
+    async def _update_progress(self, progress: discord.Message, verb: str,
+                               rows: List[Tuple[int, int, int, str, str, str]], total: int):
+        while True:
+            await asyncio.sleep(self.RAID_PROGRESS_INTERVAL)
+            try:
+                await progress.edit(embed=self._progress_embed(verb, rows, total, False))
+            except discord.HTTPException as e:
+                logging.warning(f"safety:raid progress update failed: {e}")
+                return
+
+    async def _bulk_action(self, ctx: BlackListContext, action: str,
+                           targets: List[discord.abc.Snowflake], dry_run: bool, note: Optional[str] = None):
+        verb = "Ban" if action == ctx.BAN else "Kick"
+        skipped = [t for t in targets if self._is_protected(ctx, t)]
+        targets = [t for t in targets if not self._is_protected(ctx, t)]
+        if skipped:
+            note = " ".join(filter(None, (note, f"{len(skipped)} users were skipped because they are the owner, you, "
+                                                f"the bot, or have a role at or above yours.")))
+        if not await self._confirm_bulk_action(ctx, verb, targets, dry_run, note):
+            return
+
+        now = datetime.utcnow().isoformat()
+        rows: List[Tuple[int, int, int, str, str, str]] = [
+            (ctx.guild_id, ctx.author_id, t.id, verb.lower(), "skipped", now) for t in skipped
+        ]
+        total = len(rows) + len(targets)
+        semaphore = asyncio.Semaphore(self.RAID_CONCURRENCY)
+        progress = await ctx.send(embed=self._progress_embed(verb, rows, total, False))
+
+        async def run(target: discord.abc.Snowflake):
+            result = await self._bulk_target(ctx, action, target, semaphore)
+            rows.append((ctx.guild_id, ctx.author_id, target.id, verb.lower(), result, datetime.utcnow().isoformat()))
+
+        updater = self.bot.loop.create_task(self._update_progress(progress, verb, rows, total))
+        try:
+            await asyncio.gather(*(run(t) for t in targets))
+        finally:
+            updater.cancel()
+            await self._record_actions(rows)
+            try:
+                await progress.edit(embed=self._progress_embed(verb, rows, total, True))
+            except discord.HTTPException as e:
+                logging.warning(f"safety:raid progress update failed: {e}")
+
     @commands.Cog.listener()
     async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
         if payload.member.bot:
@@ -284,8 +586,10 @@ class Safety(commands.Cog):
                 await reaction.remove(member)
                 return
             await msg.clear_reaction(BlackListContext.KICK)
-            if m := msg.guild.get_member(r.reported):
+            if m := msg.guild.get_member(report.reported):
                 await m.kick()
+                await self._record_actions([(guild.id, member.id, report.reported, "kick", "ok",
+                                             datetime.utcnow().isoformat())])
                 await msg.edit(
                     embed=add_desc(msg, f"<@{payload.user_id}> Kicked")
                 )
@@ -294,17 +598,20 @@ class Safety(commands.Cog):
                 await reaction.remove(member)
                 return
             await msg.clear_reaction(BlackListContext.BAN)
-            await guild.ban(await self.bot.fetch_user(r.reported))
+            # discord.Object saves a user fetch, the ban endpoint only needs the id
+            await guild.ban(discord.Object(report.reported))
+            await self._record_actions([(guild.id, member.id, report.reported, "ban", "ok",
+                                         datetime.utcnow().isoformat())])
             await msg.edit(
                 embed=add_desc(msg, f"<@{payload.user_id}> Banned")
             )
             return
-        reported = await self.bot.fetch_user(r.reported)
         if reaction.emoji == BlackListContext.PUBLIC:
             if not member.guild_permissions.ban_members:
                 await reaction.remove(member)
                 return
             await msg.clear_reaction(BlackListContext.PUBLIC)
+            reported = await self.bot.fetch_user(report.reported)
             await self._ensure_guild_entry(guild)
             channel = self.bot.get_channel(self.guild_settings[guild.id][1])
             if not channel:
@@ -312,7 +619,7 @@ class Safety(commands.Cog):
             await channel.send(
                 embed=discord.Embed(
                     title="Blacklist report",
-                    description=r.reason
+                    description=report.reason
                 )
                     .add_field(name="User", value=f"{reported} - {reported.id}")
             )
@@ -12,7 +12,8 @@ bot = BlackListBot(command_prefix="bl!", help_command=None)
 
 extensions = {
     "Hidden": {
-        "cogs.safety": "Safety"
+        "cogs.safety": "Safety",
+        "cogs.profiler": "Profiler"
     },
     "Misc": {
         "cogs.help": "Help"